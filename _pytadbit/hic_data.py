@@ -15,7 +15,7 @@ from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
-from numpy                          import nanmax
+from numpy                          import nanmax, fromiter, int64
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
@@ -106,14 +106,10 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.iteritems():
-            row, col = round(key / self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
+        nnz = dict.__len__(self)
+        keys = fromiter(self.iterkeys(), dtype=int64, count=nnz)
+        values = fromiter(self.itervalues(), dtype=float, count=nnz)
+        rows, cols = keys // self.__size, keys % self.__size
 
         return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
 
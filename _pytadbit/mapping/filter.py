@@ -3,8 +3,12 @@
 
 
 """
-from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from itertools import compress, imap, izip, chain
+from mmap      import mmap, ACCESS_READ
+from shutil    import copyfileobj
+from os        import remove
 import multiprocessing as mu
+import numpy as np
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False, 
                  verbose=True):
@@ -26,67 +30,58 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     filters = filters or masked.keys()
     filter_names = []
     filter_handlers = {}
+    # next read ID to be found in each filter file (read IDs are listed in
+    # the same order as in fnam), as a dictionary of filters by read ID
+    current = {}
     for k in filters:
         try:
             fh = open(masked[k]['fnam'])
-            val = fh.next().strip()
-            filter_handlers[k] = [val, fh]
+            current.setdefault(fh.next().strip(), []).append(k)
+            filter_handlers[k] = fh
         except StopIteration:
             pass
 
-    out = open(outfile, 'w')
-    fhandler = open(fnam)
+    out = open(outfile, 'w', 1 << 22)
+    mm, pos = _open_mmap(fnam)
     # get the header
-    pos = 0
-    while True:
-        line = next(fhandler)
-        if not line.startswith('#'):
-            break
-        pos += len(line)
-        out.write(line)
-    fhandler.seek(pos)
-
-    current = set([v for v, _ in filter_handlers.values()])
+    out.write(mm[:pos])
+
+    # kept lines are written by runs of consecutive lines, as slices of the
+    # block of lines being read
     count = 0
-    if reverse:
-        for line in fhandler:
+    for block in _iter_blocks(mm, pos):
+        run = beg = 0 # start of the current run of kept lines, and of the line
+        for line in block.splitlines(True):
             read = line.split('\t', 1)[0]
-            if read in current:
+            found = read in current
+            if found:
+                _next_filtered(current, read, filter_handlers)
+            if found == reverse:
                 count += 1
-                out.write(line)
             else:
-                continue
-            # iterate over different filters to update current filters
-            for k in filter_handlers.keys():
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = filter_handlers[k][1].next().strip()
-                except StopIteration:
-                    del filter_handlers[k]
-            current = set([v for v, _ in filter_handlers.values()])
-    else:
-        for line in fhandler:
-            read = line.split('\t', 1)[0]
-            if read not in current:
-                count += 1
-                out.write(line)
-                continue
-            # iterate over different filters to update current filters
-            for k in filter_handlers.keys():
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = filter_handlers[k][1].next().strip()
-                except StopIteration:
-                    del filter_handlers[k]
-            current = set([v for v, _ in filter_handlers.values()])
+                if run < beg:
+                    out.write(block[run:beg])
+                run = beg + len(line)
+            beg += len(line)
+        out.write(block[run:])
     if verbose:
         print '    saving to file %d reads %s %s.' % (
             count, 'with' if reverse else 'without', ', '.join(filter_names))
     out.close()
+    mm.close()
     return count
 
+def _next_filtered(current, read, filter_handlers):
+    """
+    Replaces a read ID found in the file of reads by the next read ID of each
+    filter file pointing to it (only these files are read)
+    """
+    for k in current.pop(read):
+        try: # get next line from filter file
+            current.setdefault(filter_handlers[k].next().strip(), []).append(k)
+        except StopIteration:
+            del filter_handlers[k]
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
@@ -140,7 +135,8 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, the file is split in as many pieces
+       as CPUs available, each filtered by a different process
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
        a set of read IDs to be removed
@@ -151,37 +147,59 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not output:
         output = fnam
 
-    if not fast: # mainly for debugging
-        if verbose:
-            print 'filtering duplicates'
-        masked, total = _filter_duplicates(fnam,output)
-        if verbose:
-            print 'filtering same fragments'
-        masked.update(_filter_same_frag(fnam, max_molecule_length, output))
-        if verbose:
-            print 'filtering fro RE'
-        masked.update(_filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                                       re_proximity, min_frag_size, output))
-        if verbose:
-            print 'filtering over representeds'
-        masked.update(_filter_over_represented(fnam, over_represented, output))
-    else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
+    masked = {1 : {'name': 'self-circle'       , 'reads': 0},
+              2 : {'name': 'dangling-end'      , 'reads': 0},
+              3 : {'name': 'error'             , 'reads': 0},
+              4 : {'name': 'extra dangling-end', 'reads': 0},
+              5 : {'name': 'too close from RES', 'reads': 0},
+              6 : {'name': 'too short'         , 'reads': 0},
+              7 : {'name': 'too large'         , 'reads': 0},
+              8 : {'name': 'over-represented'  , 'reads': 0},
+              9 : {'name': 'duplicated'        , 'reads': 0},
+              10: {'name': 'random breaks'     , 'reads': 0}}
+    for k in masked:
+        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+
+    # the file is split in pieces of complete lines, each processed by a
+    # different CPU (a single one if not fast, mainly for debugging)
+    pieces = _split_file(fnam, mu.cpu_count() if fast else 1)
+    pool = mu.Pool(len(pieces)) if fast and len(pieces) > 1 else None
+
+    if verbose:
+        print 'counting reads per RE fragment'
+    frag_count = {}
+    for counts in _map(pool, _count_re_fragments,
+                       [(fnam, beg, end) for beg, end in pieces]):
+        for frag, count in counts.iteritems():
+            frag_count[frag] = frag_count.get(frag, 0) + count
+    over_frags = _over_represented_fragments(frag_count, over_represented)
+    del frag_count
+
+    if verbose:
+        print 'filtering reads'
+    outputs = [dict((k, '%s_%d' % (masked[k]['fnam'], i)) for k in masked)
+               for i in xrange(len(pieces))]
+    results = _map(pool, _filter_piece,
+                   [(fnam, beg, end, outputs[i], over_frags,
+                     max_molecule_length, max_frag_size, min_frag_size,
+                     re_proximity, min_dist_to_re)
+                    for i, (beg, end) in enumerate(pieces)])
+    if pool:
         pool.close()
         pool.join()
-        masked, total = d.get()
-        masked.update(b.get())
-        masked.update(c.get())
-        masked.update(a.get())
+
+    # gather the IDs of filtered reads, keeping the order of the input file
+    total = 0
+    for counts, nreads in results:
+        total += nreads
+        for k in masked:
+            masked[k]['reads'] += counts[k]
+    for k in masked:
+        out = open(masked[k]['fnam'], 'w')
+        for piece in outputs:
+            copyfileobj(open(piece[k]), out)
+            remove(piece[k])
+        out.close()
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -205,174 +223,158 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         #         total) * 100)
     return masked
 
-def _filter_same_frag(fnam, max_molecule_length, output):
-    # t0 = time()
-    masked = {1 : {'name': 'self-circle'       , 'reads': 0}, 
-              2 : {'name': 'dangling-end'      , 'reads': 0},
-              3 : {'name': 'error'             , 'reads': 0},
-              4 : {'name': 'extra dangling-end', 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             cr1, pos1, sd1, _, _, re1,
-             cr2, pos2, sd2, _, _, re2) = line.split('\t')
-            ps1, ps2, sd1, sd2 = map(int, (pos1, pos2, sd1, sd2))
-            if cr1 == cr2:
-                if re1 == re2.rstrip():
-                    if sd1 != sd2:
-                        if (ps2 > ps1) == sd2:
-                            # ----<===---===>---                   self-circles
-                            masked[1]["reads"] += 1
-                            outfil[1].write(read + '\n')
-                        else:
-                            # ----===>---<===---                   dangling-ends
-                            masked[2]["reads"] += 1
-                            outfil[2].write(read + '\n')
-                    else:
-                        # --===>--===>-- or --<===--<===-- or same errors
-                        masked[3]["reads"] += 1
-                        outfil[3].write(read + '\n')
-                elif (abs(ps1 - ps2) < max_molecule_length
-                      and sd2 != sd1
-                      and (ps2 > ps1) != sd2):
-                    # different fragments but facing and very close
-                    masked[4]["reads"] += 1
-                    outfil[4].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 1', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+def _map(pool, func, args_list):
+    """
+    Calls func with each tuple of arguments, in parallel if a pool of
+    processes is given
 
-def _filter_duplicates(fnam, output):
-    total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
-        total += 1
-        prev_elts = new_elts
-    # print 'done 4', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked, total
+    :returns: the list of results, in the same order as args_list
+    """
+    if pool is None:
+        return [func(*args) for args in args_list]
+    jobs = [pool.apply_async(func, args=args) for args in args_list]
+    return [job.get() for job in jobs]
 
-def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                     re_proximity, min_frag_size, output):
-    # t0 = time()
-    masked = {5 : {'name': 'too close from RES', 'reads': 0},
-              6 : {'name': 'too short'         , 'reads': 0},
-              7 : {'name': 'too large'         , 'reads': 0},
-              10: {'name': 'random breaks'     , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             _, pos1, _, _, rs1, re1,
-             _, pos2, _, _, rs2, re2) = line.split('\t')
-            ps1, ps2, re1, rs1, re2, rs2 = map(int, (pos1, pos2, re1, rs1, re2, rs2))
-            diff11 = re1 - ps1
-            diff12 = ps1 - rs1
-            diff21 = re2 - ps2
-            diff22 = ps2 - rs2
-            if ((diff11 < re_proximity) or
-                (diff12 < re_proximity) or 
-                (diff21 < re_proximity) or
-                (diff22 < re_proximity)):
-                # multicontacts excluded if fragment is internal (not the first)
-                if not '~' in read:
-                    masked[5]["reads"] += 1
-                    outfil[5].write(read + '\n')
-            if (((diff11 > min_dist_to_re) and
-                 (diff12 > min_dist_to_re)) or 
-                ((diff21 > min_dist_to_re) and
-                 (diff22 > min_dist_to_re))):
-                masked[10]["reads"] += 1
-                outfil[10].write(read + '\n')
-            dif1 = re1 - rs1
-            dif2 = re2 - rs2
-            if (dif1 < min_frag_size) or (dif2 < min_frag_size):
-                masked[6]["reads"] += 1
-                outfil[6].write(read + '\n')
-            if (dif1 > max_frag_size) or (dif2 > max_frag_size):
-                masked[7]["reads"] += 1
-                outfil[7].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 2', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+def _count_re_fragments(fnam, beg, end):
+    """
+    Counts the number of read-ends falling in each RE fragment, in a piece of
+    the file (as :func:`pytadbit.mapping.restriction_enzymes.count_re_fragments`
+    does for the whole file)
+    """
+    frag_count = {}
+    for cols in _read_chunks(fnam, beg, end):
+        for frag in chain(izip(cols[1], cols[5]), izip(cols[7], cols[11])):
+            frag_count[frag] = frag_count.get(frag, 0) + 1
+    return frag_count
 
-def _filter_over_represented(fnam, over_represented, output):
-    # t0 = time()
-    frag_count = count_re_fragments(fnam)
+def _over_represented_fragments(frag_count, over_represented):
+    """
+    :returns: the set of RE fragments with more read-ends than the
+       (1 - over_represented) quantile
+    """
     num_frags = len(frag_count)
+    if not num_frags:
+        return set()
     cut = int((1 - over_represented) * num_frags + 0.5)
     # use cut-1 because it represents the length of the list
-    cut = sorted([frag_count[crm] for crm in frag_count])[cut - 1]
-    masked = {8 : {'name': 'over-represented'  , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            read, cr1,  _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
-            if (frag_count.get((cr1, rs1), 0) > cut or
-                  frag_count.get((cr2, rs2), 0) > cut):
-                masked[8]["reads"] += 1
-                outfil[8].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 3', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+    # partial sort (linear time), we only need the value at position cut-1
+    counts = np.fromiter(frag_count.itervalues(), dtype=np.int64,
+                         count=num_frags)
+    cut = int(np.partition(counts, cut - 1)[cut - 1])
+    return set(frag for frag, count in frag_count.iteritems() if count > cut)
+
+def _filter_piece(fnam, beg, end, outputs, over_frags, max_molecule_length,
+                  max_frag_size, min_frag_size, re_proximity, min_dist_to_re):
+    """
+    Applies all filters to the pairs of reads in a piece of the file, each
+    chunk of lines being parsed only once.
+
+    :param outputs: dictionary with, for each filter, the path to the file
+       where to write the IDs of the filtered reads
+
+    :returns: the number of reads filtered by each filter, and the number of
+       pairs of reads in the piece
+    """
+    counts = dict((k, 0) for k in outputs)
+    outfil = dict((k, open(outputs[k], 'w')) for k in outputs)
+    crm_code = {}
+    # the first pair of reads is compared to the last one of the previous piece
+    prev_keys = _previous_keys(fnam, beg, crm_code)
+    total = 0
+    for cols in _read_chunks(fnam, beg, end):
+        total += len(cols[0])
+        dups, prev_keys = _filter_duplicates(cols, prev_keys, crm_code)
+        for k, reads, mask in chain(
+            _filter_same_frag(cols, max_molecule_length),
+            _filter_from_res(cols, max_frag_size, min_dist_to_re,
+                             re_proximity, min_frag_size),
+            _filter_over_represented(cols, over_frags), dups):
+            counts[k] += _write_reads(outfil[k], reads, mask)
+    for k in outfil:
         outfil[k].close()
-    return masked
+    return counts, total
+
+def _filter_same_frag(cols, max_molecule_length):
+    (read,
+     cr1, pos1, sd1, _, _, re1,
+     cr2, pos2, sd2, _, _, re2) = cols
+    # only intra-chromosomal pairs of reads can be filtered here, other
+    # columns are converted to integers only for them
+    cis = np.fromiter(imap(str.__eq__, cr1, cr2), dtype=bool,
+                      count=len(read))
+    read = list(compress(read, cis))
+    ps1, ps2, sd1, sd2, re1, re2 = [_to_int(compress(col, cis)) for col in
+                                    (pos1, pos2, sd1, sd2, re1, re2)]
+    same = re1 == re2
+    facing = sd1 != sd2
+    inward = (ps2 > ps1) != sd2
+    # these filters are exclusive, one label per pair of reads is enough
+    # (0 for pairs not filtered here)
+    labels = np.zeros(len(read), dtype=np.int8)
+    # --===>--===>-- or --<===--<===-- or same errors
+    labels[same] = 3
+    # ----<===---===>---                                      self-circles
+    labels[same & facing & ~inward] = 1
+    # ----===>---<===---                                     dangling-ends
+    labels[same & facing & inward] = 2
+    # different fragments but facing and very close
+    labels[~same & facing & inward
+           & (abs(ps1 - ps2) < max_molecule_length)] = 4
+    return [(k, read, labels == k) for k in (1, 2, 3, 4)]
+
+def _filter_duplicates(cols, prev_keys, crm_code):
+    (read,
+     cr1, pos1, sd1, _ , _, _,
+     cr2, pos2, sd2, _ , _, _) = cols
+    # reads are sorted by position, duplicates are consecutive: each pair of
+    # reads is compared to the previous one (the first of a chunk to the last
+    # of the previous chunk)
+    # one integer per read-end packing chromosome, position and strand
+    new_keys = [_read_end_keys(cr, pos, sd, crm_code)
+                for cr, pos, sd in ((cr1, pos1, sd1), (cr2, pos2, sd2))]
+    dups = np.ones(len(read), dtype=bool)
+    for new_col in new_keys:
+        dups[1:] &= new_col[1:] == new_col[:-1]
+    if prev_keys is None:
+        dups[0] = False
+    else:
+        for prev_col, new_col in zip(prev_keys, new_keys):
+            dups[0] &= prev_col[-1] == new_col[0]
+    return [(9, read, dups)], new_keys
+
+def _filter_from_res(cols, max_frag_size, min_dist_to_re,
+                     re_proximity, min_frag_size):
+    (read,
+     _, pos1, _, _, rs1, re1,
+     _, pos2, _, _, rs2, re2) = cols
+    ps1, ps2, re1, rs1, re2, rs2 = map(_to_int,
+                                       (pos1, pos2, re1, rs1, re2, rs2))
+    diff11 = re1 - ps1
+    diff12 = ps1 - rs1
+    diff21 = re2 - ps2
+    diff22 = ps2 - rs2
+    close = ((diff11 < re_proximity) |
+             (diff12 < re_proximity) |
+             (diff21 < re_proximity) |
+             (diff22 < re_proximity))
+    # multicontacts excluded if fragment is internal (not the first)
+    close[close] = ['~' not in r for r in compress(read, close)]
+    breaks = (((diff11 > min_dist_to_re) & (diff12 > min_dist_to_re)) |
+              ((diff21 > min_dist_to_re) & (diff22 > min_dist_to_re)))
+    dif1 = re1 - rs1
+    dif2 = re2 - rs2
+    short = (dif1 < min_frag_size) | (dif2 < min_frag_size)
+    large = (dif1 > max_frag_size) | (dif2 > max_frag_size)
+    return [(5, read, close), (10, read, breaks), (6, read, short),
+            (7, read, large)]
+
+def _filter_over_represented(cols, over_frags):
+    read, cr1, rs1, cr2, rs2 = cols[0], cols[1], cols[5], cols[7], cols[11]
+    over = np.fromiter(imap(over_frags.__contains__, izip(cr1, rs1)),
+                       dtype=bool, count=len(read))
+    over |= np.fromiter(imap(over_frags.__contains__, izip(cr2, rs2)),
+                        dtype=bool, count=len(read))
+    return [(8, read, over)]
 
 
 def _filter_yannick(fnam, maxlen, de_left, de_right, output):
@@ -450,3 +452,147 @@ def _filter_yannick(fnam, maxlen, de_left, de_right, output):
     return masked
 
 
+def _open_mmap(fnam):
+    """
+    Memory-maps (read-only) a tsv file with pairs of reads. Several passes
+    over the file, or several processes reading it, share the same pages of
+    the OS cache.
+
+    :param fnam: path to the tsv file
+
+    :returns: the mmap object and the position of the first line after the
+       header
+    """
+    fhandler = open(fnam)
+    mm = mmap(fhandler.fileno(), 0, access=ACCESS_READ)
+    fhandler.close()
+    pos = 0
+    while mm[pos:pos + 1] == '#':
+        pos = mm.find('\n', pos) + 1 or mm.size()
+    return mm, pos
+
+
+def _split_file(fnam, npieces):
+    """
+    Splits the lines of a tsv file with pairs of reads (after the header) in
+    pieces of similar size.
+
+    :param fnam: path to the tsv file
+    :param npieces: number of pieces wanted (less are returned if the file has
+       less lines)
+
+    :returns: a list of (begin, end) positions in the file, each piece
+       containing only complete lines
+    """
+    mm, pos = _open_mmap(fnam)
+    size = mm.size()
+    bounds = [pos]
+    for i in xrange(1, npieces):
+        cut = mm.find('\n', pos + (size - pos) * i / npieces) + 1 or size
+        if cut > bounds[-1]:
+            bounds.append(cut)
+    if size > bounds[-1]:
+        bounds.append(size)
+    mm.close()
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _iter_blocks(mm, pos, end=None, block_size=1048576):
+    """
+    Iterates over a memory-mapped file by blocks of complete lines.
+
+    :param mm: mmap object
+    :param pos: position in the file where to start
+    :param None end: position in the file where to stop (end of file by
+       default)
+    :param 1048576 block_size: minimum size of each block, in bytes
+
+    :yields: strings containing complete lines (including the end-of-line)
+    """
+    if end is None:
+        end = mm.size()
+    while pos < end:
+        stop = mm.find('\n', pos + block_size, end) + 1 or end
+        yield mm[pos:stop]
+        pos = stop
+
+
+def _read_chunks(fnam, beg, end, chunk_size=262144):
+    """
+    Iterates over the pairs of reads stored in a piece of a tsv file (as
+    generated by :func:`pytadbit.mapping.mapper.get_intersection`).
+
+    :param fnam: path to the tsv file
+    :param beg: position in the file of the first line of the piece
+    :param end: position in the file of the end of the piece
+    :param 262144 chunk_size: approximate size in bytes of each chunk of
+       lines
+
+    :yields: for each chunk of lines, the list of its columns (each column
+       being a list of strings)
+    """
+    mm, _ = _open_mmap(fnam)
+    for block in _iter_blocks(mm, beg, end, chunk_size):
+        # a single split of the whole chunk is much faster than one per line
+        block = block.rstrip('\n')
+        ncol = block.count('\t', 0, block.find('\n')) + 1
+        nlines = block.count('\n') + 1
+        tokens = block.replace('\n', '\t').split('\t')
+        if len(tokens) != ncol * nlines:
+            raise Exception('ERROR: unequal column number in %s' % fnam)
+        yield [tokens[col::ncol] for col in xrange(ncol)]
+    mm.close()
+
+
+def _to_int(column):
+    """
+    Converts a column of strings (any iterable) into a numpy array of integers
+    """
+    return np.fromstring(' '.join(column), dtype=np.int64, sep=' ')
+
+
+def _read_end_keys(crms, positions, strands, crm_code):
+    """
+    Packs the chromosome, position and strand of each read into a single
+    integer (positions should fit in 40 bits).
+
+    :param crms: column of chromosome names
+    :param positions: column of positions
+    :param strands: column of strands
+    :param crm_code: dictionary of integer codes of chromosomes, updated with
+       new chromosome names
+
+    :returns: a numpy array of integers
+    """
+    codes = np.fromiter((crm_code.setdefault(c, len(crm_code)) for c in crms),
+                        dtype=np.int64, count=len(crms))
+    return (codes << 41) | (_to_int(positions) << 1) | _to_int(strands)
+
+
+def _previous_keys(fnam, pos, crm_code):
+    """
+    Keys (see :func:`_read_end_keys`) of the read-ends of the pair of reads
+    preceding a given position in a tsv file
+
+    :returns: None if there is no pair of reads before this position
+    """
+    mm, start = _open_mmap(fnam)
+    if pos <= start:
+        mm.close()
+        return None
+    line = mm[mm.rfind('\n', start, pos - 1) + 1 or start:pos]
+    mm.close()
+    cols = [[val] for val in line.rstrip('\n').split('\t')]
+    return _filter_duplicates(cols, None, crm_code)[1]
+
+
+def _write_reads(outfil, reads, mask):
+    """
+    Writes to an open file the read IDs selected by a boolean mask
+
+    :returns: the number of reads written
+    """
+    selected = list(compress(reads, mask))
+    if selected:
+        outfil.write('\n'.join(selected) + '\n')
+    return len(selected)
@@ -4,13 +4,20 @@ November 7, 2013.
 """
 
 from warnings                import warn
-from math                    import sqrt, isnan
+from math                    import sqrt
 from pytadbit.parsers.gzopen import gzopen
 from collections             import OrderedDict
 from pytadbit                import HiC_data
+from itertools               import izip, chain, islice
+from scipy.sparse            import coo_matrix
+import numpy as np
 
 HIC_DATA = True
 
+# largest count that can be stored in 32 bits, also once summed with its
+# symmetric cell
+INT32_MAX = np.iinfo(np.int32).max
+
 
 class AutoReadFail(Exception):
     """
@@ -22,55 +29,65 @@ class AutoReadFail(Exception):
 def is_asymmetric(matrix):
     """
     Helper functions for the autoreader.
+
+    :param matrix: square numpy array or list of lists
     """
-    maxn = len(matrix)
-    for i in range(maxn):
-        maxi = matrix[i] # slightly more efficient
-        for j in range(i+1, maxn):
-            if maxi[j] != matrix[j][i]:
-                if isnan(maxi[j]) and isnan(matrix[j][i]):
-                    continue
-                return True
-    return False
+    matrix = np.asarray(matrix)
+    diff = matrix != matrix.T
+    if matrix.dtype.kind == 'f':
+        # NaNs are never equal, but are symmetric if found in both halves
+        diff &= ~(np.isnan(matrix) & np.isnan(matrix.T))
+    return bool(diff.any())
 
 
 def is_asymmetric_dico(hic):
     """
     Helper functions for the optimal_reader
     """
-    ncol = len(hic)
-    for i in xrange(ncol):
-        for j in xrange(i, ncol):
-            p1 = i * ncol + j
-            p2 = j * ncol + i
-            if hic.get(p1, 0) != hic.get(p2, 0):
-                return True
-    return False
+    matrix = _sparse_from_dico(hic)
+    return (matrix != matrix.T).nnz != 0
 
 
 def symmetrize_dico(hic):
     """
     Make an HiC_data object symmetric by summing two halves of the matrix
     """
-    ncol = len(hic)
-    for i in xrange(ncol):
-        incol = i * ncol
-        for j in xrange(i, ncol):
-            p1 = incol + j
-            p2 = j * ncol + i
-            val = hic.get(p1, 0) + hic.get(p2, 0)
-            if val:
-                hic[p1] = hic[p2] = val
+    size = len(hic)
+    matrix = _sparse_from_dico(hic)
+    matrix = matrix + matrix.T
+    matrix.eliminate_zeros()
+    matrix = matrix.tocoo()
+    keys = matrix.row.astype(np.int64) * size + matrix.col
+    # dict.update does not go through HiC_data.__setitem__
+    hic.update(izip(keys.tolist(), matrix.data.tolist()))
+
+
+def _sparse_from_dico(hic):
+    """
+    Helper function to get the cells stored in an HiC_data object as a scipy
+    sparse matrix (only stored cells are visited)
+    """
+    size = len(hic)
+    keys = np.fromiter(hic.iterkeys(), dtype=np.int64, count=dict.__len__(hic))
+    vals = np.array(hic.values())
+    return coo_matrix((vals, (keys // size, keys % size)),
+                      shape=(size, size)).tocsr()
 
 
 def symmetrize(matrix):
     """
     Make a matrix symmetric by summing two halves of the matrix
+
+    :param matrix: square numpy array or list of lists, modified in place
     """
-    maxn = len(matrix)
-    for i in range(maxn):
-        for j in range(i, maxn):
-            matrix[i][j] = matrix[j][i] = matrix[i][j] + matrix[j][i]
+    if isinstance(matrix, np.ndarray):
+        # the transpose is a view on the same memory, in-place operations on
+        # overlapping arrays are only safe from numpy 1.13
+        matrix += matrix.T.copy()
+        return
+    summed = np.asarray(matrix)
+    for i, row in enumerate((summed + summed.T).tolist()):
+        matrix[i][:] = row
 
 
 def optimal_reader(f, normalized=False, resolution=1):
@@ -85,64 +102,53 @@ def optimal_reader(f, normalized=False, resolution=1):
     """
     # get masked bins
     masked = {}
-    pos = 0
     for line in f:
         if line[0] != '#':
             break
-        pos += len(line)
         if line.startswith('# MASKED'):
             masked = dict([(int(n), True) for n in line.split()[2:]])
-    f.seek(pos)
-
-    # super fast
-    header = [tuple(line.split(None, 2)[:2]) for line in f]
-
-    f.seek(pos)
 
-    ncol = len(header)
-    
-    # Get the numeric values and remove extra columns
-    num = float if normalized else int
+    # Get the numeric values and remove extra columns, rows are parsed by
+    # blocks of around one million cells with numpy
+    dtype = float if normalized else np.int64
+    ncol = len(line.split()) - 2
+    nrow_block = max(1, 1000000 / ncol)
+    lines = chain([line], f)
+    header = []
+    # store non-zero cells as a sparse matrix in coordinate format (three
+    # arrays instead of one dictionary entry per cell)
+    rows, cols, vals = [], [], []
+    while True:
+        block = list(islice(lines, nrow_block))
+        if not block:
+            break
+        values = []
+        for line in block:
+            crm, pos, row = line.split(None, 2)
+            header.append((crm, pos))
+            values.append(row)
+        values = _parse_numbers(values, dtype, len(block) * ncol
+                                ).reshape(len(block), ncol)
+        row, col = np.nonzero(values)
+        rows.append((row + (len(header) - len(block))).astype(np.int32))
+        cols.append(col.astype(np.int32))
+        vals.append(values[row, col])
+    vals = np.concatenate(vals)
+    if not normalized:
+        vals = _compact_counts(vals)
+    matrix = coo_matrix((vals, (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(ncol, ncol)).tocsr()
     chromosomes, sections, resolution = _header_to_section(header, resolution)
 
-    #############################################################
-    # monkey patch HiC_data to make it faster
-    def fast_setitem(self, key, val):
-        "Use directly dict setitem"
-        super(HiC_data, self).__setitem__(key, val)
-
-    def fast_getitem(self, key):
-        "Use directly dict setitem"
-        try:
-            return super(HiC_data, self).__getitem__(key)
-        except KeyError:
-            return 0
-
-    original_setitem = HiC_data.__setitem__
-    original_getitem = HiC_data.__getitem__
-    # apply_async the patch
-    HiC_data.__setitem__ = fast_setitem
-    HiC_data.__getitem__ = fast_getitem
-
-    hic = HiC_data(((j, num(v))
-                    for i, line in enumerate(f)
-                    for j, v in enumerate(line.split()[2:], i * ncol)
-                    if num(v)), size=ncol, masked=masked,
-                   dict_sec=sections, chromosomes=chromosomes,
-                   resolution=resolution, symmetricized=False)
-
-    # make it symmetric
-    if is_asymmetric_dico(hic):
-        hic.symmetricized = True
-        symmetrize_dico(hic)
-
-    # undo patching
-    HiC_data.__setitem__ = original_setitem
-    HiC_data.__getitem__ = original_getitem
-    hic.__setitem__ = original_setitem
-    hic.__getitem__ = original_getitem
-    #############################################################
-    return hic
+    # make it symmetric by summing both halves (diagonal counted twice),
+    # directly on the sparse matrix, before filling the HiC_data object
+    symmetricized = (matrix != matrix.T).nnz != 0
+    if symmetricized:
+        matrix = matrix + matrix.T
+    return _hic_data_from_sparse(matrix, masked=masked,
+                                 dict_sec=sections, chromosomes=chromosomes,
+                                 resolution=resolution,
+                                 symmetricized=symmetricized)
 
 
 def autoreader(f):
@@ -151,7 +157,7 @@ def autoreader(f):
     
     :param f: an iterable (typically an open file).
     
-    :returns: A tuple with integer values and the dimension of
+    :returns: A flat numpy array with the values and the dimension of
        the matrix.
     """
 
@@ -215,10 +221,12 @@ def autoreader(f):
         del(items[0])
         nrow -= 1
         header = [tuple([a for a in line[:trim]]) for line in items]
-    # Get the numeric values and remove extra columns
-    num = int if HIC_DATA else float
+    # Get the numeric values and remove extra columns (rows are joined back
+    # one by one, so that no python loop runs over single cells)
+    num = np.int64 if HIC_DATA else float
     try:
-        items = [[num(a) for a in line[trim:]] for line in items]
+        items = _parse_numbers((' '.join(line[trim:]) for line in items),
+                               num, nrow * (ncol - trim))
     except ValueError:
         if not HIC_DATA:
             raise AutoReadFail('ERROR: non numeric values')
@@ -242,12 +250,88 @@ def autoreader(f):
     if ncol != nrow:
         raise AutoReadFail('ERROR: non square matrix')
 
+    items = np.array(items).reshape(nrow, ncol)
+    if HIC_DATA:
+        items = _compact_counts(items)
     symmetricized = False
     if is_asymmetric(items):
         warn('WARNING: matrix not symmetric: summing cell_ij with cell_ji')
         symmetrize(items)
         symmetricized = True
-    return tuple([a for line in items for a in line]), ncol, header, masked, symmetricized
+    return items.ravel(), ncol, header, masked, symmetricized
+
+
+def _parse_numbers(strings, dtype, count):
+    """
+    Converts strings of whitespace-separated numbers into a flat numpy array,
+    using the C parser of numpy instead of converting each item in python.
+
+    :param strings: iterable of strings (numbers or lines of numbers)
+    :param dtype: numpy type of the values
+    :param count: expected number of values
+
+    :raises ValueError: if one of the items is not a number of type dtype
+    """
+    # numpy stops silently at the first item that can not be parsed
+    # completely, a trailing 0 is added to be sure to detect it
+    values = np.fromstring(' '.join(chain(strings, ['0'])), dtype=dtype,
+                           sep=' ')
+    if len(values) != count + 1:
+        raise ValueError('non numeric values')
+    return values[:-1]
+
+
+def _compact_counts(values):
+    """
+    Converts a numpy array of integer counts to 32 bits integers (half the
+    memory of 64 bits), if they can be symmetrized without overflow.
+
+    :param values: numpy array of integers
+
+    :returns: the converted array, or the same array with a warning if its
+       values are too large
+    """
+    if not values.size:
+        return values.astype(np.int32)
+    if max(values.max(), -values.min()) > INT32_MAX / 2:
+        warn('WARNING: counts too large for 32 bits integers, using 64 bits')
+        return values
+    return values.astype(np.int32)
+
+
+def _hic_data_from_dense(matrix, size, **kwargs):
+    """
+    Creates an HiC_data object from the non-zero cells of a dense matrix.
+
+    :param matrix: square matrix as a numpy array, a list of lists, or
+       flattened into a single list or tuple
+    :param size: number of rows of the matrix
+    :param kwargs: parameters passed to HiC_data (e.g.: masked, dict_sec...)
+
+    :returns: HiC_data object
+    """
+    matrix = np.asarray(matrix).ravel()
+    nonzero = np.flatnonzero(matrix)
+    return HiC_data(izip(nonzero.tolist(), matrix[nonzero].tolist()), size,
+                    **kwargs)
+
+
+def _hic_data_from_sparse(matrix, **kwargs):
+    """
+    Creates an HiC_data object from the non-zero cells of a scipy sparse
+    matrix.
+
+    :param matrix: square scipy sparse matrix
+    :param kwargs: parameters passed to HiC_data (e.g.: masked, dict_sec...)
+
+    :returns: HiC_data object
+    """
+    size = matrix.shape[0]
+    matrix = matrix.tocsr()
+    matrix.eliminate_zeros()
+    matrix = matrix.tocoo()
+    keys = matrix.row.astype(np.int64) * size + matrix.col
+    return HiC_data(izip(keys.tolist(), matrix.data.tolist()), size, **kwargs)
 
 
 def _header_to_section(header, resolution):
@@ -255,31 +339,35 @@ def _header_to_section(header, resolution):
     converts row-names of the form 'chr12\t1000-2000' into sections, suitable
     to create HiC_data objects. Also creates chromosomes, from the reads
     """
-    chromosomes = OrderedDict()
-    sections = {}
     sections = {}
     chromosomes = None
     if (isinstance(header, list)
         and isinstance(header[0], tuple)
         and len(header[0]) > 1):
-        chromosomes = OrderedDict()
-        for i, h in enumerate(header):
-            if '-' in h[1]:
-                a, b = map(int, h[1].split('-'))
-                if resolution==1:
-                    resolution = abs(b - a)
-                elif resolution != abs(b - a):
-                    raise Exception('ERROR: found different resolution, ' +
-                                    'check headers')
-            else:
-                a = int(h[1])
-                if resolution==1 and i:
-                    resolution = abs(a - b)
-                elif resolution == 1:
-                    b = a
-            sections[(h[0], a / resolution)] = i
-            chromosomes.setdefault(h[0], 0)
-            chromosomes[h[0]] += 1
+        crms = [h[0] for h in header]
+        # start and end of each bin (end is optional), all rows at once
+        parts = np.char.partition(np.array([h[1] for h in header]), '-')
+        dashed = parts[:, 1] == '-'
+        beg = _parse_numbers(parts[:, 0], np.int64, len(header))
+        if dashed.any():
+            end = _parse_numbers(np.where(dashed, parts[:, 2], parts[:, 0]),
+                                 np.int64, len(header))
+            widths = abs(end - beg)[dashed]
+            if resolution == 1:
+                resolution = int(widths[0])
+            if (widths != resolution).any():
+                raise Exception('ERROR: found different resolution, ' +
+                                'check headers')
+        elif resolution == 1 and len(beg) > 1:
+            resolution = int(abs(beg[1] - beg[0]))
+        sections = dict(izip(izip(crms, (beg // resolution).tolist()),
+                             xrange(len(crms))))
+        # number of rows per chromosome, in order of appearance
+        names, first, counts = np.unique(crms, return_index=True,
+                                         return_counts=True)
+        order = np.argsort(first)
+        chromosomes = OrderedDict(izip(names[order].tolist(),
+                                       counts[order].tolist()))
     return chromosomes, sections, resolution
 
 def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
@@ -321,16 +409,16 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     for thing in things:
         if isinstance(thing, HiC_data):
             matrices.append(thing)
-        elif isinstance(thing, file):
+            continue
+        params = {}
+        if isinstance(thing, file):
             matrix, size, header, masked, sym = parser(thing)
             thing.close()
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
-                                      if matrix[i]], size, dict_sec=sections,
-                                     chromosomes=chromosomes,
-                                     resolution=resolution,
-                                     symmetricized=sym, masked=masked))
+            params = dict(dict_sec=sections, chromosomes=chromosomes,
+                          resolution=resolution, symmetricized=sym,
+                          masked=masked)
         elif isinstance(thing, str):
             try:
                 matrix, size, header, masked, sym = parser(gzopen(thing))
@@ -339,22 +427,17 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                     matrix, size, header, masked, sym = parser(thing.split('\n'))
                 else:
                     raise IOError('\n   ERROR: file %s not found\n' % thing)
-            sections = dict([(h, i) for i, h in enumerate(header)])
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
-                                      if matrix[i]], size, dict_sec=sections,
-                                     chromosomes=chromosomes, masked=masked,
-                                     resolution=resolution,
-                                     symmetricized=sym))
+            params = dict(dict_sec=sections, chromosomes=chromosomes,
+                          masked=masked, resolution=resolution,
+                          symmetricized=sym)
         elif isinstance(thing, list):
             if all([len(thing)==len(l) for l in thing]):
-                matrix  = [v for l in thing for v in l]
+                matrix = thing
                 size = len(thing)
             else:
                 raise Exception('must be list of lists, all with same length.')
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
-                                      if matrix[i]], size))
         elif isinstance(thing, tuple):
             # case we know what we are doing and passing directly list of tuples
             matrix = thing
@@ -362,21 +445,18 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             if int(siz) != siz:
                 raise AttributeError('ERROR: matrix should be square.\n')
             size = int(siz)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
-                                      if matrix[i]], size))
         elif 'matrix' in str(type(thing)):
             try:
                 row, col = thing.shape
                 if row != col:
                     raise Exception('matrix needs to be square.')
-                matrix  = thing.reshape(-1).tolist()[0]
+                matrix = thing
                 size = row
             except Exception as exc:
                 print 'Error found:', exc
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
-                                      if matrix[i]], size))
         else:
             raise Exception('Unable to read this file or whatever it is :)')
+        matrices.append(_hic_data_from_dense(matrix, size, **params))
     if one:
         return matrices[0]
     else:
@@ -410,21 +490,63 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
             section_sizes[(crm,)] = len_crm
             sections.extend([(crm, i) for i in xrange(len_crm)])
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
-    try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) / resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) / resolution)]
-            except KeyError:
-                ps1 = int(ps1) / resolution
-                ps2 = int(ps2) / resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
+    # position of the first bin of each chromosome (dict_sec[(crm, i)] is
+    # equal to crm_start[crm] + i), used to find the bins of whole chunks of
+    # reads with numpy
+    crm_code = dict((crm, i) for i, crm in enumerate(genome_seq))
+    crm_start = np.cumsum([0] + genome_seq.values()[:-1], dtype=np.int64)
+    crm_size = np.array(genome_seq.values(), dtype=np.int64)
+    # pairs of bins are counted by chunks of reads into a sparse matrix, with
+    # 32 bits integers as long as the number of reads (each one counted in
+    # both halves of the matrix) can not overflow them
+    dtype = np.int32
+    nreads = 0
+    matrix = coo_matrix((size, size), dtype=dtype).tocsr()
+    lines = chain([line], fhandler)
+    blocks = iter(lambda: list(islice(lines, 100000)), [])
+    while True:
+        # up to 100 blocks of reads (10 million pairs of bins) at once
+        bins = [_reads_to_bins(block, resolution, crm_code, crm_start,
+                               crm_size, dict_sec)
+                for block in islice(blocks, 100)]
+        if not bins:
+            break
+        ps1 = np.concatenate([b[0] for b in bins])
+        ps2 = np.concatenate([b[1] for b in bins])
+        nreads += len(ps1)
+        if nreads > INT32_MAX / 2:
+            dtype = np.int64
+            matrix = matrix.astype(dtype)
+        matrix = matrix + coo_matrix((np.ones(len(ps1), dtype=dtype),
+                                      (ps1, ps2)), shape=(size, size)).tocsr()
+    # each read counts in both halves of the matrix
+    imx = _hic_data_from_sparse(matrix + matrix.T, chromosomes=genome_seq,
+                                dict_sec=dict_sec, resolution=resolution)
     imx.symmetricized = True
     return imx
 
+
+def _reads_to_bins(lines, resolution, crm_code, crm_start, crm_size,
+                   dict_sec):
+    """
+    Converts the chromosomes and positions of a chunk of pairs of reads into
+    the indexes of their bins in the matrix.
+
+    :returns: two numpy arrays with the bins of the first and second reads
+    """
+    cols = zip(*[line.split('\t', 9)[1:9] for line in lines])
+    bins = []
+    found = np.ones(len(lines), dtype=bool)
+    for crm, pos in ((cols[0], cols[1]), (cols[6], cols[7])):
+        pos = np.fromstring(' '.join(pos), dtype=np.int64, sep=' ') / resolution
+        if not dict_sec:
+            bins.append((pos, pos))
+            continue
+        code = np.array([crm_code.get(c, -1) for c in crm], dtype=np.int64)
+        found &= code >= 0
+        found &= pos < crm_size[code]
+        bins.append((pos, crm_start[code] + pos))
+    # if one of the reads is not in the sections, positions are used as bins
+    if not dict_sec:
+        found[:] = False
+    return [np.where(found, idx, pos).astype(np.int32) for pos, idx in bins]